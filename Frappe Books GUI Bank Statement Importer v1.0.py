@@ -1,14 +1,217 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import sqlite3
-import csv
-import re
-import xml.etree.ElementTree as ET
 from datetime import datetime
-from decimal import Decimal
 import os
 import sys
-import shutil  # Added for database backup functionality
+import json
+import bisect
+# Parser- and feature-specific modules (csv, re, xml.etree, decimal, mmap, shutil,
+# secrets, hashlib) are imported where they're used, to keep start-up fast.
+
+# --- Importer-managed indexes on the ledger table ---
+# Clearly prefixed so they can be told apart from Frappe Books' own indexes
+# and dropped again without touching anything else.
+IMPORTER_INDEXES = {
+    "importer_idx_ledger_account_date": ("account", "date"),
+    "importer_idx_ledger_voucher": ("voucherType", "voucherNo"),
+}
+
+# Re-gather planner statistics after imports of at least this many transactions
+ANALYZE_THRESHOLD = 1000
+
+# QIF '!Type:' sections that hold transactions (the rest are lists: Cat, Class, Memorized, ...).
+# 'Invst' registers are left out: their 'T' total is unsigned and its direction comes from
+# the action (Buy, Sell, Div, ...), so reading them as cash would post buys as deposits.
+QIF_TRANSACTION_TYPES = {'bank', 'cash', 'ccard', 'oth a', 'oth l'}
+
+# QIF field prefixes that carry nothing we import
+QIF_IGNORED_PREFIXES = {'N', 'C', 'A', 'F', 'X', '%', 'Y', 'I', 'Q', 'O', 'K', 'B'}
+
+# Rows per executemany() batch when bulk-inserting
+IMPORT_BATCH_SIZE = 5000
+
+# Number series used for importer-created Journal Entries if the DB has none
+JOURNAL_ENTRY_SERIES = "JV-"
+
+# Resumable imports: importer-owned progress table and vouchers committed per checkpoint
+PROGRESS_TABLE = "ImporterProgress"
+CHECKPOINT_CHUNK = 500
+
+# --- Pre-import validation ---
+# Days of grace around the statement period before a date is flagged
+VALIDATION_DATE_GRACE_DAYS = 7
+# Without a statement period: flag dates this far from the median month
+VALIDATION_MAX_MONTHS_FROM_MEDIAN = 12
+# Flag amounts this many orders of magnitude above the 90th percentile
+VALIDATION_OUTLIER_MAGNITUDES = 2
+# Descriptions sampled for the sign-convention check
+VALIDATION_SIGN_SAMPLE = 20000
+VALIDATION_INFLOW_WORDS = r'salary|payroll|wages|refund|deposit|dividend|interest (?:earned|credit)|transfer from'
+VALIDATION_OUTFLOW_WORDS = r'withdrawal|\batm\b|\bfee\b|purchase|eftpos|\bpos\b|direct debit|bpay|card payment|transfer to'
+
+# Maximum number of matches shown in an account picker's dropdown
+ACCOUNT_PICKER_LIMIT = 50
+
+# Small local file for remembered choices (last bank account and CSV mapping per
+# statement source, last statement folder) and the last session's DB state
+SETTINGS_PATH = os.path.join(os.path.expanduser("~"), ".frappe_books_importer.json")
+
+# --- Helper Classes ---
+
+class StatementReader:
+    """
+    Read-only, memory-mapped view of a statement file. Record boundaries are
+    scanned on the raw bytes and only the fields a parser asks for are decoded,
+    with the file's encoding decided once up front (UTF-8, else latin-1).
+    """
+
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        # mmap can't map an empty file
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.view = memoryview(self.data)
+        self.start = 3 if self.data[:3] == b'\xef\xbb\xbf' else 0 # Skip a UTF-8 BOM
+        self.offset = self.start # End offset of the last line handed out
+        self.encoding = self._detect_encoding()
+
+    def _detect_encoding(self):
+        import re
+        # A multi-byte UTF-8 sequence never contains ASCII bytes, so validating
+        # each run of non-ASCII bytes is enough; the rest is never touched.
+        for match in re.finditer(rb'[\x80-\xff]+', self.data):
+            try:
+                match.group().decode('utf-8')
+            except UnicodeDecodeError:
+                return 'latin-1' # Common in bank files
+        return 'utf-8'
+
+    def decode(self, chunk, errors='strict'):
+        return str(chunk, self.encoding, errors)
+
+    def lines(self):
+        """
+        Yields (end_offset, memoryview) for each line, without the line ending.
+        Like text mode, '\n', '\r\n' and a lone '\r' (old Mac exports) all end a line.
+        """
+        import re
+        data, view, size = self.data, self.view, self.size
+        pos = self.start
+        if not re.compile(rb'\r(?!\n)').search(data, pos):
+            # Only '\n' or '\r\n' endings: split on '\n' alone
+            while pos < size:
+                end = data.find(b'\n', pos)
+                next_pos = size if end == -1 else end + 1
+                if end == -1:
+                    end = size
+                if end > pos and data[end - 1] == 13: # '\r'
+                    end -= 1
+                self.offset = next_pos
+                yield next_pos, view[pos:end]
+                pos = next_pos
+            return
+        
+        # Lone '\r' endings, possibly mixed with the others. Each of the next '\n' and
+        # '\r' is only searched for again once passed, so the file is scanned once.
+        next_lf = data.find(b'\n', pos)
+        next_cr = data.find(b'\r', pos)
+        while pos < size:
+            if 0 <= next_lf < pos:
+                next_lf = data.find(b'\n', pos)
+            if 0 <= next_cr < pos:
+                next_cr = data.find(b'\r', pos)
+            if next_cr != -1 and (next_lf == -1 or next_cr < next_lf):
+                end = next_cr
+                next_pos = end + 2 if next_lf == end + 1 else end + 1 # Swallow the '\n' of '\r\n'
+            elif next_lf != -1:
+                end = next_lf
+                next_pos = end + 1
+            else:
+                end = next_pos = size
+            self.offset = next_pos
+            yield next_pos, view[pos:end]
+            pos = next_pos
+
+    def text_lines(self):
+        """Yields decoded lines (with '\n') for the csv module; self.offset tracks the position."""
+        for _, line in self.lines():
+            yield self.decode(line) + '\n'
+
+    def sample(self, size=1024):
+        return self.decode(self.view[self.start:self.start + size], errors='ignore')
+
+    def close(self):
+        self.view.release()
+        try:
+            if self.size:
+                self.data.close()
+        except BufferError:
+            pass # A caller still holds a slice; the map is closed when it's collected
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AccountIndex:
+    """
+    Prefix/substring index over account names and types, used by the
+    type-ahead account pickers so large charts of accounts stay usable.
+    """
+
+    def __init__(self, accounts, account_types=None):
+        self.accounts = list(accounts)
+        account_types = account_types or {}
+        
+        # Sorted (word, position) pairs: any word of the name or type, plus the
+        # full name, can be found by prefix with a bisect instead of a scan.
+        keys = []
+        self.haystacks = []
+        for pos, name in enumerate(self.accounts):
+            acc_type = account_types.get(name) or ""
+            haystack = f"{name} {acc_type}".lower()
+            self.haystacks.append(haystack)
+            for word in set(haystack.split()) | {name.lower()}:
+                keys.append((word, pos))
+        keys.sort()
+        self.keys = keys
+        self.words = [k[0] for k in keys]
+
+    def search(self, text, limit=ACCOUNT_PICKER_LIMIT):
+        """Returns up to `limit` account names matching `text`, prefix matches first."""
+        text = text.strip().lower()
+        if not text:
+            return self.accounts[:limit]
+        
+        found = set()
+        results = []
+        
+        # 1. Prefix matches on names and words
+        i = bisect.bisect_left(self.words, text)
+        while i < len(self.words) and self.words[i].startswith(text):
+            pos = self.keys[i][1]
+            if pos not in found:
+                found.add(pos)
+                results.append(pos)
+            i += 1
+        results.sort() # Keep the chart's alphabetical order
+        
+        # 2. Substring matches anywhere in name or type
+        if len(results) < limit:
+            for pos, haystack in enumerate(self.haystacks):
+                if text in haystack and pos not in found:
+                    found.add(pos)
+                    results.append(pos)
+                    if len(results) >= limit:
+                        break
+        
+        return [self.accounts[pos] for pos in results[:limit]]
+
 
 # --- GUI Application Class ---
 
@@ -26,14 +229,25 @@ class ImporterApp:
         self.statement_path = tk.StringVar()
         self.bank_account = tk.StringVar()
         self.suspense_account = tk.StringVar()
+        self.create_journal_entries = tk.BooleanVar(value=False)
+        self.detect_transfers = tk.BooleanVar(value=False)
+        self.transfer_window_days = tk.IntVar(value=3)
+        self.checkpoint_import = tk.BooleanVar(value=False)
         
         self.all_accounts = []
+        self.account_set = set()
+        self.account_types = {}
+        self.account_index = AccountIndex([])
+        self.settings = self.load_settings()
+        # Supporting indexes are opt-in; the choice is remembered across launches
+        self.manage_indexes = tk.BooleanVar(value=bool(self.settings.get('manage_indexes', False)))
         self.csv_headers = []
         self.csv_guesses = {}
         
         # --- Store correct table names ---
         self.account_table_name = None
         self.ledger_table_name = None
+        self.schema_catalog = {} # table name -> list of column names
         
         # --- CSV Mapping Vars ---
         self.csv_date_var = tk.StringVar()
@@ -41,6 +255,12 @@ class ImporterApp:
         self.csv_amt_var = tk.StringVar()
         self.csv_debit_var = tk.StringVar()
         self.csv_credit_var = tk.StringVar()
+        self.csv_balance_var = tk.StringVar()
+        
+        # --- Statement metadata (balances, period) filled in by the parsers ---
+        self.statement_info = {}
+        # (db_path, account) -> (before_date, balance, ledger high-water rowid)
+        self.balance_cache = {}
 
         # --- Main Frame ---
         main_frame = ttk.Frame(root, padding="10")
@@ -53,12 +273,15 @@ class ImporterApp:
         ttk.Label(db_frame, text="Database File:").grid(row=0, column=0, sticky=tk.W)
         ttk.Entry(db_frame, textvariable=self.db_path, width=60, state='readonly').grid(row=1, column=0, padx=5)
         ttk.Button(db_frame, text="Browse...", command=self.load_db).grid(row=1, column=1, padx=5)
+        ttk.Checkbutton(db_frame, text="Create supporting indexes", variable=self.manage_indexes,
+                        command=self.save_index_choice).grid(row=2, column=0, sticky=tk.W, padx=5)
+        ttk.Button(db_frame, text="Remove Indexes", command=self.remove_indexes).grid(row=2, column=1, padx=5)
         
         # --- 2. Statement File Selection ---
         file_frame = ttk.LabelFrame(main_frame, text="2. Bank Statement", padding="10")
         file_frame.grid(row=1, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
         
-        ttk.Label(file_frame, text="Statement File (QIF, OFX, CSV):").grid(row=0, column=0, sticky=tk.W)
+        ttk.Label(file_frame, text="Statement File (QIF, OFX, CSV, camt.053/.054 XML):").grid(row=0, column=0, sticky=tk.W)
         ttk.Entry(file_frame, textvariable=self.statement_path, width=60, state='readonly').grid(row=1, column=0, padx=5)
         ttk.Button(file_frame, text="Browse...", command=self.load_statement).grid(row=1, column=1, padx=5)
 
@@ -67,20 +290,34 @@ class ImporterApp:
         map_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
         
         ttk.Label(map_frame, text="Bank/Loan Account (Debit/Credit):").grid(row=0, column=0, sticky=tk.E, padx=5)
-        self.bank_menu = ttk.OptionMenu(map_frame, self.bank_account, "Load Database First", *[])
-        self.bank_menu.grid(row=0, column=1, sticky=(tk.W, tk.E), padx=5)
+        self.bank_picker = self._make_account_picker(map_frame, self.bank_account)
+        self.bank_picker.grid(row=0, column=1, sticky=(tk.W, tk.E), padx=5)
         
         ttk.Label(map_frame, text="Suspense Account:").grid(row=1, column=0, sticky=tk.E, padx=5)
-        self.suspense_menu = ttk.OptionMenu(map_frame, self.suspense_account, "Load Database First", *[])
-        self.suspense_menu.grid(row=1, column=1, sticky=(tk.W, tk.E), padx=5)
+        self.suspense_picker = self._make_account_picker(map_frame, self.suspense_account)
+        self.suspense_picker.grid(row=1, column=1, sticky=(tk.W, tk.E), padx=5)
+        
+        ttk.Checkbutton(map_frame, text="Create Journal Entries (editable in Frappe Books)",
+                        variable=self.create_journal_entries).grid(row=2, column=1, sticky=tk.W, padx=5)
+        
+        transfer_frame = ttk.Frame(map_frame)
+        transfer_frame.grid(row=3, column=1, sticky=tk.W, padx=5)
+        ttk.Checkbutton(transfer_frame, text="Match transfers between own accounts within",
+                        variable=self.detect_transfers).grid(row=0, column=0, sticky=tk.W)
+        ttk.Spinbox(transfer_frame, from_=0, to=30, width=4, textvariable=self.transfer_window_days).grid(row=0, column=1, padx=2)
+        ttk.Label(transfer_frame, text="days").grid(row=0, column=2, sticky=tk.W)
+        
+        ttk.Checkbutton(map_frame, text="Commit in checkpoints (resumable large imports)",
+                        variable=self.checkpoint_import).grid(row=4, column=1, sticky=tk.W, padx=5)
+        map_frame.columnconfigure(1, weight=1)
         
         # --- 4. CSV Options (Initially hidden) ---
         self.csv_frame = ttk.LabelFrame(main_frame, text="4. CSV Column Mapping", padding="10")
         # self.csv_frame will be grid()'ed later if a CSV is loaded
         
         self.csv_option_menus = {}
-        csv_labels = ["Date", "Description", "Amount (Single)", "Debit (Two-Col)", "Credit (Two-Col)"]
-        self.csv_vars = [self.csv_date_var, self.csv_desc_var, self.csv_amt_var, self.csv_debit_var, self.csv_credit_var]
+        csv_labels = ["Date", "Description", "Amount (Single)", "Debit (Two-Col)", "Credit (Two-Col)", "Balance (Running)"]
+        self.csv_vars = [self.csv_date_var, self.csv_desc_var, self.csv_amt_var, self.csv_debit_var, self.csv_credit_var, self.csv_balance_var]
         
         for i, label in enumerate(csv_labels):
             ttk.Label(self.csv_frame, text=f"{label} Column:").grid(row=i, column=0, sticky=tk.E, padx=5, pady=2)
@@ -109,6 +346,141 @@ class ImporterApp:
         root.columnconfigure(0, weight=1)
         root.rowconfigure(0, weight=1)
         main_frame.columnconfigure(1, weight=1) # Allow entry/menus to expand
+        
+        # Bring back the last session once the window is on screen
+        root.after_idle(self.restore_session)
+
+    # --- Account Pickers ---
+    def _make_account_picker(self, parent, var):
+        """Creates a type-ahead combobox that only ever holds the current matches."""
+        picker = ttk.Combobox(parent, textvariable=var, width=40)
+        picker.set("Load Database First")
+        picker.configure(postcommand=lambda: self._filter_picker(picker))
+        picker.bind('<KeyRelease>', lambda event: self._on_picker_typed(picker, event))
+        picker.bind('<<ComboboxSelected>>', lambda event: self.check_ready_to_import())
+        picker.bind('<FocusOut>', lambda event: self.check_ready_to_import())
+        return picker
+
+    def _filter_picker(self, picker):
+        """Refreshes the dropdown with the accounts matching the typed text."""
+        text = picker.get()
+        if text in self.account_set:
+            text = "" # Show the full (limited) list when a valid account is already chosen
+        picker['values'] = self.account_index.search(text)
+
+    def _on_picker_typed(self, picker, event):
+        if event.keysym in ('Up', 'Down', 'Return', 'Escape', 'Tab'):
+            return
+        self._filter_picker(picker)
+        self.check_ready_to_import()
+
+    # --- Settings ---
+    def load_settings(self):
+        """Loads remembered choices from the local settings file."""
+        try:
+            with open(SETTINGS_PATH, 'r', encoding='utf-8') as f:
+                settings = json.load(f)
+            return settings if isinstance(settings, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save_settings(self):
+        try:
+            with open(SETTINGS_PATH, 'w', encoding='utf-8') as f:
+                json.dump(self.settings, f, indent=2)
+        except OSError as e:
+            print(f"Could not save settings: {e}")
+
+    # --- Session State ---
+    def _db_fingerprint(self, path):
+        """(mtime, schema_version) of the database; unchanged means cached state is still valid."""
+        mtime = os.stat(path).st_mtime
+        conn = sqlite3.connect(path)
+        try:
+            schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        finally:
+            conn.close()
+        return mtime, schema_version
+
+    def save_session(self):
+        """Persists the loaded database's state so the next launch can skip the full load."""
+        path = self.db_path.get()
+        try:
+            mtime, schema_version = self._db_fingerprint(path)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Could not save session: {e}")
+            return
+        self.settings['session'] = {
+            'db_path': path,
+            'db_mtime': mtime,
+            'schema_version': schema_version,
+            'account_table_name': self.account_table_name,
+            'ledger_table_name': self.ledger_table_name,
+            'schema_catalog': self.schema_catalog,
+            'accounts': self.all_accounts,
+            'account_types': self.account_types,
+            'bank_account': self.bank_account.get(),
+            'suspense_account': self.suspense_account.get(),
+        }
+        self.save_settings()
+
+    def remember_session_accounts(self):
+        """Updates the chosen accounts only; the DB fingerprint stays as it was when loaded."""
+        session = self.settings.get('session')
+        if session and session.get('db_path') == self.db_path.get():
+            session['bank_account'] = self.bank_account.get()
+            session['suspense_account'] = self.suspense_account.get()
+            self.save_settings()
+
+    def restore_session(self):
+        """
+        Restores the last session if its database is unchanged (same mtime and
+        schema_version), skipping the backup, schema probe and account load.
+        """
+        session = self.settings.get('session')
+        if not session or not session.get('accounts'):
+            return
+        path = session.get('db_path')
+        try:
+            fingerprint = self._db_fingerprint(path)
+        except (OSError, sqlite3.Error, TypeError):
+            return # Moved or deleted
+        if fingerprint != (session.get('db_mtime'), session.get('schema_version')):
+            self.log_status("Database changed since the last session. Load it again to refresh.")
+            return
+        
+        self.db_path.set(path)
+        self.balance_cache.clear()
+        self.account_table_name = session['account_table_name']
+        self.ledger_table_name = session['ledger_table_name']
+        self.schema_catalog = session.get('schema_catalog') or {}
+        self.all_accounts = session['accounts']
+        self.account_types = session.get('account_types') or {}
+        self.account_set = set(self.all_accounts)
+        self.account_index = AccountIndex(self.all_accounts, self.account_types)
+        
+        if session.get('bank_account') in self.account_set:
+            self.bank_account.set(session['bank_account'])
+        else:
+            self.bank_account.set(self.all_accounts[0])
+        if session.get('suspense_account') in self.account_set:
+            self.suspense_account.set(session['suspense_account'])
+        else:
+            self.suspense_account.set(self.default_suspense_account())
+        
+        self.log_status(f"Restored last session: {os.path.basename(path)} (unchanged since it was loaded).")
+        self.check_ready_to_import()
+
+    def _statement_source_key(self, path):
+        """
+        Identifies where a statement came from, ignoring the dates and
+        sequence numbers that change between downloads
+        (e.g. 'Westpac_2025-01.csv' and 'Westpac_2025-02.csv' match).
+        """
+        import re
+        stem, ext = os.path.splitext(os.path.basename(path))
+        source = re.sub(r'[\d\W_]+', ' ', stem.lower()).strip()
+        return f"{source}{ext.lower()}"
 
     # --- Logging Methods ---
     def log_error(self, message):
@@ -134,6 +506,23 @@ class ImporterApp:
                 continue # Doesn't exist, try next
         return None
 
+    def get_schema_catalog(self, conn):
+        """Reads every table's column list from the database."""
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+        catalog = {}
+        for (table,) in cursor.fetchall():
+            cursor.execute(f"PRAGMA table_info({table});")
+            catalog[table] = [info[1] for info in cursor.fetchall()]
+        return catalog
+
+    def _catalog_table(self, name):
+        """Finds a table in the schema catalog, case-insensitively."""
+        for table in self.schema_catalog:
+            if table.lower() == name.lower():
+                return table
+        return None
+
     def connect_db(self, db_path):
         """Establishes a connection to the SQLite database."""
         try:
@@ -153,22 +542,41 @@ class ImporterApp:
             self.log_error("Account table name not found.")
             return []
 
+        cursor = conn.cursor()
+        self.account_types = {}
+        
+        try:
+            cursor.execute(f"PRAGMA table_info({self.account_table_name});")
+            account_columns = [info[1] for info in cursor.fetchall()]
+        except sqlite3.Error:
+            account_columns = []
+
+        # Build the query from the detected columns: skip group accounts and
+        # pick up a type column for the pickers' search index
+        type_col = next((c for c in ('accountType', 'rootType', 'type') if c in account_columns), None)
+        select_cols = f"name, {type_col}" if type_col else "name, NULL"
+        if 'isGroup' in account_columns:
+            where = "WHERE COALESCE(isGroup, 0) = 0"
+        elif 'type' in account_columns:
+            where = "WHERE type IS NULL OR type NOT IN ('Group')"
+        else:
+            where = ""
+
         queries_to_try = [
-            f"SELECT name FROM {self.account_table_name} WHERE type NOT IN ('Group') ORDER BY name",
-            f"SELECT name FROM {self.account_table_name} ORDER BY name"
+            f"SELECT {select_cols} FROM {self.account_table_name} {where} ORDER BY name",
+            f"SELECT name, NULL FROM {self.account_table_name} ORDER BY name"
         ]
-        
-        cursor = conn.cursor()
 
-        # Try to get accounts, gracefully handling if 'type' column is missing
+        # Try to get accounts, falling back to all names if the filtered query fails
         for query in queries_to_try:
             try:
                 cursor.execute(query)
-                accounts = [row[0] for row in cursor.fetchall()]
+                rows = cursor.fetchall()
+                accounts = [row[0] for row in rows]
+                self.account_types = {row[0]: row[1] or "" for row in rows}
                 if accounts:
                     break
             except sqlite3.Error as e:
-                # This will happen if 'type' column is missing on the first query
                 continue
                 
         if not accounts:
@@ -181,9 +589,6 @@ class ImporterApp:
         if "Suspense Clearing" not in accounts:
             try:
                 # --- FIX: Dynamically build query based on existing columns ---
-                cursor.execute(f"PRAGMA table_info({self.account_table_name});")
-                account_columns = [info[1] for info in cursor.fetchall()]
-                
                 # Default values for a basic schema
                 sql_cols_dict = {
                     "name": "Suspense Clearing",
@@ -222,6 +627,7 @@ class ImporterApp:
                 conn.commit()
                 accounts.append("Suspense Clearing")
                 accounts.sort()
+                self.account_types["Suspense Clearing"] = "Suspense"
                 self.log_status("Created 'Suspense Clearing' account.")
                 
             except sqlite3.Error as e:
@@ -231,7 +637,7 @@ class ImporterApp:
 
     def check_and_fix_schema(self, conn):
         """
-        Checks for 'remark', 'voucherType', 'voucherNo' columns and adds them if missing.
+        Checks for 'remark', 'voucherType', 'voucherNo', 'bankReference' columns and adds them if missing.
         Uses the dynamically found self.ledger_table_name.
         """
         if not self.ledger_table_name:
@@ -257,9 +663,22 @@ class ImporterApp:
                 cursor.execute(f"ALTER TABLE {self.ledger_table_name} ADD COLUMN voucherNo TEXT;")
                 added_cols.append('voucherNo')
             
-            if added_cols:
+            # The bank's own reference (camt AcctSvcrRef), so overlapping files aren't imported twice
+            if 'bankReference' not in columns:
+                cursor.execute(f"ALTER TABLE {self.ledger_table_name} ADD COLUMN bankReference TEXT;")
+                added_cols.append('bankReference')
+            
+            # Indexes go after the columns, as they cover voucherType/voucherNo
+            added_indexes = self.ensure_indexes(conn) if self.manage_indexes.get() else []
+            
+            if added_cols or added_indexes:
                 conn.commit()
-                self.log_status(f"Database schema updated: Added column(s) {', '.join(added_cols)}.")
+                changes = []
+                if added_cols:
+                    changes.append(f"Added column(s) {', '.join(added_cols)}")
+                if added_indexes:
+                    changes.append(f"Created index(es) {', '.join(added_indexes)}")
+                self.log_status(f"Database schema updated: {'; '.join(changes)}.")
             else:
                 self.log_status("Database schema is OK.")
             
@@ -269,6 +688,63 @@ class ImporterApp:
             self.log_error(f"Database schema error: {e}. Could not check/fix columns.")
             return False
 
+    def ensure_indexes(self, conn):
+        """
+        Creates any missing importer-managed indexes on the ledger table.
+        Returns the names of the indexes that were created (caller commits).
+        """
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (self.ledger_table_name,))
+        existing = {row[0] for row in cursor.fetchall()}
+        
+        created = []
+        for index_name, columns in IMPORTER_INDEXES.items():
+            if index_name in existing:
+                continue
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.ledger_table_name} ({', '.join(columns)})")
+            created.append(index_name)
+        return created
+
+    def save_index_choice(self):
+        """Remembers whether importer-managed indexes should be created on load."""
+        self.settings['manage_indexes'] = self.manage_indexes.get()
+        self.save_settings()
+
+    def remove_indexes(self):
+        """Drops the importer-managed indexes from the loaded database."""
+        db_path = self.db_path.get()
+        if not db_path or not self.ledger_table_name:
+            self.log_error("Load a database first.")
+            return
+        
+        conn = self.connect_db(db_path)
+        if not conn:
+            return
+        
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (self.ledger_table_name,))
+            existing = {row[0] for row in cursor.fetchall()}
+            
+            dropped = [name for name in IMPORTER_INDEXES if name in existing]
+            for index_name in dropped:
+                cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+            conn.commit()
+            
+            # Don't silently re-create them on the next load or launch
+            self.manage_indexes.set(False)
+            self.save_index_choice()
+            
+            if dropped:
+                self.log_status(f"Removed index(es): {', '.join(dropped)}.")
+            else:
+                self.log_status("No importer indexes to remove.")
+        except sqlite3.Error as e:
+            conn.rollback()
+            self.log_error(f"Could not remove indexes: {e}")
+        finally:
+            conn.close()
+
     # --- File Parsing Logic ---
     def parse_date(self, date_str):
         """
@@ -328,135 +804,355 @@ class ImporterApp:
 
     def parse_qif(self, file_path):
         """
-        Parses a QIF file, designed to be robust for non-standard files like myob.qif.
+        Parses a QIF file in a single pass, designed to be robust for non-standard files like myob.qif.
+        Tracks !Type/!Account sections (multi-account exports) and keeps S/E/$ split lines as split legs.
+        """
+        with StatementReader(file_path) as reader:
+            return self._parse_qif_lines(reader)
+
+    def _parse_qif_lines(self, reader):
+        """
+        State machine over QIF lines; a record ends only on a line starting with '^'.
+        Works on the raw line bytes and only decodes the fields it keeps.
         """
+        from decimal import Decimal
         transactions = []
-        try:
-            # Use 'latin-1' encoding as a fallback, common in bank files
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            with open(file_path, 'r', encoding='latin-1') as f:
-                content = f.read()
-                
-        # Split by the end-of-transaction marker '^'
-        raw_transactions = content.split('^')
         
-        for raw_tx in raw_transactions:
-            lines = raw_tx.strip().split('\n')
-            if not lines or len(lines) < 2:
+        section = None          # Current '!Type:' (None if the file has no header)
+        account = None          # Current '!Account' name, for multi-account exports
+        in_account_block = False
+        account_fields = {}
+        
+        current = {}
+        description_parts = []
+        splits = []
+        skipped_investments = 0
+        
+        decode = reader.decode
+        for offset, raw in reader.lines():
+            if not raw:
                 continue
-
-            current = {}
-            description_parts = []
             
-            for line in lines:
-                line = line.strip()
+            prefix = chr(raw[0]).upper()
+            if prefix.isspace():
+                # Indented line: decode it whole and strip
+                line = decode(raw).strip()
                 if not line:
                     continue
-                
-                prefix = ""
-                data = ""
-                if line:
-                   prefix = line[0].upper()
-                   data = line[1:].strip()
-                
-                if prefix == 'D':
-                    current['date'] = self.parse_date(data)
-                elif prefix == 'T':
+                prefix = line[0].upper()
+                data = line[1:].strip()
+            elif prefix in QIF_IGNORED_PREFIXES and not in_account_block:
+                continue # Check number, cleared flag, address, ...
+            else:
+                line = None # Decoded below, only if needed
+                data = decode(raw[1:]).strip()
+            
+            if prefix == '!':
+                header = data.lower()
+                if header == 'account':
+                    in_account_block = True
+                    account_fields = {}
+                elif header.startswith('type:'):
+                    section = header[5:].strip()
+                    in_account_block = False
+                # '!Option:' / '!Clear:' switches need no state here
+                current, description_parts, splits = {}, [], []
+                continue
+            
+            if prefix == '^':
+                if in_account_block:
+                    account = account_fields.get('N') or account
+                    in_account_block = False
+                elif section == 'invst':
+                    skipped_investments += 1
+                elif current.get('date') and 'amount' in current:
+                    # A valid transaction must have a date and an amount
+                    current['description'] = ' / '.join(filter(None, description_parts))
+                    current['splits'] = [sp for sp in splits if 'amount' in sp]
+                    current['source_account'] = account
+                    current['offset'] = offset
+                    transactions.append(current)
+                current, description_parts, splits = {}, [], []
+                continue
+            
+            if in_account_block:
+                account_fields[prefix] = data
+                continue
+            if section is not None and section not in QIF_TRANSACTION_TYPES:
+                continue # Category/class/memorized lists
+            
+            if prefix == 'D':
+                current['date'] = self.parse_date(data)
+            elif prefix in ('T', 'U'):
+                # 'U' repeats 'T' in newer Quicken exports
+                if prefix == 'T' or 'amount' not in current:
                     try:
                         current['amount'] = Decimal(data.replace(',', ''))
                     except Exception:
                         current['amount'] = Decimal(0)
-                elif prefix == 'P':
-                    description_parts.append(data)
-                elif prefix == 'M':
-                    description_parts.append(data)
-                elif prefix == 'L':
-                    # Handle split categories, just take the first one
-                    if 'S' in data: 
-                        data = data.split('S')[-1].split('E')[0]
-                    description_parts.append(data)
-                elif prefix in ('!', 'N'): # Type or Check Number
-                    pass # Ignore
-                else:
-                    # Default case: Handle description lines with no prefix
-                    description_parts.append(line) 
-
-            # A valid transaction must have a date and an amount
-            if current.get('date') and 'amount' in current:
-                current['description'] = ' / '.join(filter(None, description_parts))
-                transactions.append(current)
-                
+            elif prefix in ('P', 'M'):
+                description_parts.append(data)
+            elif prefix == 'L':
+                current['category'] = data
+                description_parts.append(data)
+            elif prefix == 'S':
+                splits.append({'category': data, 'memo': ''})
+            elif prefix == 'E':
+                if splits:
+                    splits[-1]['memo'] = data
+            elif prefix == '$':
+                if splits:
+                    try:
+                        splits[-1]['amount'] = Decimal(data.replace(',', ''))
+                    except Exception:
+                        pass # Leg without a usable amount is left to the remainder
+            elif prefix in QIF_IGNORED_PREFIXES:
+                pass # Indented ignored field
+            else:
+                # Default case: Handle description lines with no prefix
+                description_parts.append(line if line is not None else decode(raw).strip())
+        
+        if skipped_investments:
+            self.log_status(f"Skipped {skipped_investments} investment account records (not bank transactions).")
         return transactions
 
     def parse_ofx(self, file_path):
         """
-        Parses an OFX file (v1.0 or v2.0 XML).
+        Parses an OFX file (v1.0 SGML or v2.0 XML).
+        Scans the memory-mapped bytes for <STMTTRN> blocks and only decodes the text fields.
         """
+        import re
+        from decimal import Decimal
         transactions = []
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            with open(file_path, 'r', encoding='latin-1') as f:
-                content = f.read()
-
-        # Clean content: remove whitespace between tags
-        content = re.sub(r'>\s+<', '><', content, flags=re.DOTALL)
-
-        # --- Find the main transaction block ---
-        tran_list_match = re.search(r'<BANKTRANLIST>(.*?)</BANKTRANLIST>', content, re.DOTALL | re.IGNORECASE)
-        if not tran_list_match:
-            self.log_status("Could not find <BANKTRANLIST> block in OFX file.")
-            return transactions # No transactions found
-            
-        tran_list_content = tran_list_match.group(1)
-        
-        # Split into individual transactions
-        tx_matches = re.finditer(r'<STMTTRN>(.*?)</STMTTRN>', tran_list_content, re.DOTALL | re.IGNORECASE)
-        
-        for tx_match in tx_matches:
-            tx_content = tx_match.group(1)
-            current = {}
-            
-            # Date
-            date_match = re.search(r'<DTPOSTED>(\d{8})', tx_content, re.IGNORECASE)
-            if date_match:
-                current['date'] = self.parse_date(date_match.group(1))
-            
-            # Amount
-            amt_match = re.search(r'<TRNAMT>([-\d.]+)', tx_content, re.IGNORECASE)
-            if amt_match:
-                current['amount'] = Decimal(amt_match.group(1))
+        flags = re.DOTALL | re.IGNORECASE
+        
+        with StatementReader(file_path) as reader:
+            data = reader.data
+
+            # --- Find the main transaction block ---
+            list_start = re.compile(rb'<BANKTRANLIST>', re.IGNORECASE).search(data)
+            list_end = re.compile(rb'</BANKTRANLIST>', re.IGNORECASE).search(data, list_start.end()) if list_start else None
+            if not list_start or not list_end:
+                self.log_status("Could not find <BANKTRANLIST> block in OFX file.")
+                return transactions # No transactions found
+
+            # --- Statement balances and period, for reconciliation ---
+            for tag, key in ((b'LEDGERBAL', 'closing'), (b'AVAILBAL', 'available')):
+                bal_match = re.compile(rb'<' + tag + rb'>(.*?)(?:</' + tag + rb'>|<AVAILBAL>|</STMTRS>|$)', flags).search(data, list_end.end())
+                if not bal_match:
+                    continue
+                amt_match = re.search(rb'<BALAMT>\s*([-+\d.]+)', bal_match.group(1), re.IGNORECASE)
+                date_match = re.search(rb'<DTASOF>\s*(\d{8})', bal_match.group(1), re.IGNORECASE)
+                if amt_match:
+                    self.statement_info[f'{key}_balance'] = Decimal(amt_match.group(1).decode('ascii'))
+                if date_match:
+                    self.statement_info[f'{key}_date'] = self.parse_date(date_match.group(1).decode('ascii'))
+            for tag, key in ((b'DTSTART', 'start_date'), (b'DTEND', 'end_date')):
+                date_match = re.compile(rb'<' + tag + rb'>\s*(\d{8})', re.IGNORECASE).search(data, list_start.end(), list_end.start())
+                if date_match:
+                    self.statement_info[key] = self.parse_date(date_match.group(1).decode('ascii'))
+
+            # Split into individual transactions, copying one record at a time
+            tx_pattern = re.compile(rb'<STMTTRN>(.*?)</STMTTRN>', flags)
+            date_pattern = re.compile(rb'<DTPOSTED>\s*(\d{8})', re.IGNORECASE)
+            amt_pattern = re.compile(rb'<TRNAMT>\s*([-+\d.]+)', re.IGNORECASE)
+            # Closing tags are optional in OFX 1.x, so stop at the next tag
+            name_pattern = re.compile(rb'<NAME>([^<]*)', re.IGNORECASE)
+            memo_pattern = re.compile(rb'<MEMO>([^<]*)', re.IGNORECASE)
+            
+            for tx_match in tx_pattern.finditer(data, list_start.end(), list_end.start()):
+                tx_content = tx_match.group(1)
+                current = {'offset': tx_match.end()}
                 
-            # Description (Combine NAME and MEMO)
-            name_match = re.search(r'<NAME>(.*?)</NAME>', tx_content, re.IGNORECASE)
-            memo_match = re.search(r'<MEMO>(.*?)</MEMO>', tx_content, re.IGNORECASE)
-            
-            desc_parts = []
-            if name_match and name_match.group(1) and name_match.group(1).strip():
-                desc_parts.append(name_match.group(1).strip().replace('&amp;', '&'))
-            if memo_match and memo_match.group(1) and memo_match.group(1).strip():
-                desc_parts.append(memo_match.group(1).strip().replace('&amp;', '&'))
+                # Date
+                date_match = date_pattern.search(tx_content)
+                if date_match:
+                    current['date'] = self.parse_date(date_match.group(1).decode('ascii'))
                 
-            current['description'] = ' / '.join(desc_parts)
+                # Amount
+                amt_match = amt_pattern.search(tx_content)
+                if amt_match:
+                    current['amount'] = Decimal(amt_match.group(1).decode('ascii'))
+                    
+                # Description (Combine NAME and MEMO)
+                desc_parts = []
+                for field_match in (name_pattern.search(tx_content), memo_pattern.search(tx_content)):
+                    if field_match:
+                        text = reader.decode(field_match.group(1)).strip()
+                        if text:
+                            desc_parts.append(text.replace('&amp;', '&'))
+                    
+                current['description'] = ' / '.join(desc_parts)
 
-            if current.get('date') and 'amount' in current:
-                transactions.append(current)
+                if current.get('date') and 'amount' in current:
+                    transactions.append(current)
                 
         return transactions
 
+    # --- ISO 20022 camt.053 / camt.054 ---
+    def _xml_child(self, elem, *path):
+        """
+        Follows a path of tag names, e.g. ('BookgDt', 'Dt'), in the file's namespace
+        (camt versions differ only in namespace). Returns None if missing.
+        """
+        xpath = self._camt_paths.get(path)
+        if xpath is None:
+            xpath = self._camt_paths[path] = '/'.join(self._camt_ns + name for name in path)
+        return elem.find(xpath)
+
+    def _xml_text(self, elem, *path):
+        found = self._xml_child(elem, *path)
+        if found is None or found.text is None:
+            return None
+        return found.text.strip()
+
+    def _camt_amount(self, elem):
+        """Signed amount of an element holding <Amt> and <CdtDbtInd> (DBIT is an outflow)."""
+        from decimal import Decimal
+        amount_text = self._xml_text(elem, 'Amt')
+        if not amount_text:
+            return None
+        amount = Decimal(amount_text)
+        return -amount if self._xml_text(elem, 'CdtDbtInd') == 'DBIT' else amount
+
+    def _camt_date(self, text):
+        """camt dates are ISO (YYYY-MM-DD or a full timestamp)."""
+        if not text:
+            return None
+        try:
+            return datetime.fromisoformat(text[:10])
+        except ValueError:
+            return self.parse_date(text)
+
+    def _camt_entry(self, ntry, position):
+        """Builds a transaction from one <Ntry>, or None for pending/unusable entries."""
+        status = self._xml_text(ntry, 'Sts') or self._xml_text(ntry, 'Sts', 'Cd')
+        if status and status != 'BOOK':
+            return None # Pending or informational only
+        
+        amount = self._camt_amount(ntry)
+        date = self._camt_date(self._xml_text(ntry, 'BookgDt', 'Dt') or self._xml_text(ntry, 'BookgDt', 'DtTm')
+                               or self._xml_text(ntry, 'ValDt', 'Dt') or self._xml_text(ntry, 'ValDt', 'DtTm'))
+        if amount is None or not date:
+            return None
+        
+        desc_parts = []
+        tx_details = self._xml_child(ntry, 'NtryDtls', 'TxDtls')
+        ref = self._xml_text(ntry, 'AcctSvcrRef')
+        if tx_details is not None:
+            ref = ref or self._xml_text(tx_details, 'Refs', 'AcctSvcrRef')
+            # Counterparty: who we paid, or who paid us (camt.053 v8+ nests the name under Pty)
+            party = 'Cdtr' if amount < 0 else 'Dbtr'
+            desc_parts.append(self._xml_text(tx_details, 'RltdPties', party, 'Nm')
+                              or self._xml_text(tx_details, 'RltdPties', party, 'Pty', 'Nm'))
+            remittance = self._xml_child(tx_details, 'RmtInf')
+            if remittance is not None:
+                wanted = (self._camt_ns + 'Ustrd', self._camt_ns + 'Ref')
+                for elem in remittance.iter():
+                    if elem.tag in wanted and elem.text:
+                        desc_parts.append(elem.text.strip())
+            desc_parts.append(self._xml_text(tx_details, 'AddtlTxInf'))
+        desc_parts.append(self._xml_text(ntry, 'AddtlNtryInf'))
+        
+        # Drop blanks and repeats (AddtlNtryInf often restates the remittance)
+        description = ' / '.join(dict.fromkeys(part for part in desc_parts if part))
+        return {'date': date, 'amount': amount, 'description': description, 'ref': ref, 'offset': position}
+
+    def parse_camt(self, file_path):
+        """
+        Parses an ISO 20022 camt.053 (statement) or camt.054 (notification) file,
+        including files with several statements. Streams with iterparse and
+        drops each <Ntry> once it's read, so memory stays flat on large files.
+        AcctSvcrRef is used to skip entries repeated within the file, and is
+        stored with the ledger rows so later files can skip them too.
+        Transaction positions are entry ordinals (iterparse has no byte offsets).
+        """
+        import xml.etree.ElementTree as ET
+        transactions = []
+        seen_refs = set()
+        statements = []
+        statement = None
+        statement_elem = None
+        position = 0
+        self._camt_ns = ''
+        self._camt_paths = {} # Namespaced find() paths, built once per file
+        
+        with open(file_path, 'rb') as f:
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                tag = elem.tag
+                if event == 'start':
+                    if not self._camt_ns and tag.startswith('{'):
+                        self._camt_ns = tag[:tag.index('}') + 1] # From the root element
+                    if tag[len(self._camt_ns):] in ('Stmt', 'Ntfctn', 'Rpt'):
+                        statement_elem = elem
+                        statement = {'account': None, 'names': [], 'opening': None, 'closing': None,
+                                     'start': None, 'end': None}
+                        statements.append(statement)
+                    continue
+                
+                name = tag[len(self._camt_ns):]
+                if statement is None or name not in ('Ntry', 'Acct', 'Bal', 'FrToDt'):
+                    continue
+                if name != 'Ntry' and elem not in statement_elem:
+                    continue # Same tag nested deeper, e.g. inside an entry
+                
+                if name == 'Ntry':
+                    position += 1
+                    tx = self._camt_entry(elem, position)
+                    if tx:
+                        tx['source_account'] = next((n for n in statement['names'] if n in self.account_set),
+                                                    statement['account'])
+                        key = (tx['source_account'], tx['ref'])
+                        if not tx['ref'] or key not in seen_refs:
+                            seen_refs.add(key)
+                            transactions.append(tx)
+                elif name == 'Acct':
+                    iban = self._xml_text(elem, 'Id', 'IBAN')
+                    other = self._xml_text(elem, 'Id', 'Othr', 'Id')
+                    statement['account'] = iban or other
+                    statement['names'] = [n for n in (self._xml_text(elem, 'Nm'), iban, other) if n]
+                elif name == 'Bal':
+                    code = self._xml_text(elem, 'Tp', 'CdOrPrtry', 'Cd')
+                    # Opening booked, or the previous closing if there's no opening
+                    if code == 'OPBD' or (code == 'PRCD' and statement['opening'] is None):
+                        statement['opening'] = self._camt_amount(elem)
+                    elif code == 'CLBD':
+                        statement['closing'] = self._camt_amount(elem)
+                elif name == 'FrToDt':
+                    statement['start'] = self._camt_date(self._xml_text(elem, 'FrDtTm') or self._xml_text(elem, 'FrDt'))
+                    statement['end'] = self._camt_date(self._xml_text(elem, 'ToDtTm') or self._xml_text(elem, 'ToDt'))
+                
+                # Done with this element: free it and unhook it from its statement
+                elem.clear()
+                if elem in statement_elem:
+                    statement_elem.remove(elem)
+        
+        # Reconcile against the balances when the whole file is one account
+        if statements and len({st['account'] for st in statements}) == 1:
+            first, last = statements[0], statements[-1]
+            if first['opening'] is not None:
+                self.statement_info['opening_balance'] = first['opening']
+            if last['closing'] is not None:
+                self.statement_info['closing_balance'] = last['closing']
+            if first['start']:
+                self.statement_info['start_date'] = first['start']
+            if last['end']:
+                self.statement_info['end_date'] = last['end']
+        
+        if len(statements) > 1:
+            self.log_status(f"Read {len(statements)} statements from camt file.")
+        return transactions
+
     def guess_csv_headers(self, file_path):
         """
         Reads the first 5 rows of a CSV and guesses the columns.
         """
+        import csv
         try:
-            with open(file_path, 'r', encoding='utf-8-sig') as f:
+            with StatementReader(file_path) as f:
                 # Sniff for dialect (commas, tabs, etc.)
-                dialect = csv.Sniffer().sniff(f.read(1024))
-                f.seek(0)
-                reader = csv.reader(f, dialect)
+                dialect = csv.Sniffer().sniff(f.sample())
+                reader = csv.reader(f.text_lines(), dialect)
                 
                 headers = next(reader)
                 headers_lower = [h.lower().strip() for h in headers]
@@ -466,7 +1162,8 @@ class ImporterApp:
                     'desc': None,
                     'amt': None,
                     'debit': None,
-                    'credit': None
+                    'credit': None,
+                    'balance': None
                 }
                 
                 for i, h in enumerate(headers_lower):
@@ -480,6 +1177,8 @@ class ImporterApp:
                         guesses['debit'] = headers[i]
                     if 'credit' in h or 'deposit' in h or 'paid in' in h:
                         guesses['credit'] = headers[i]
+                    if 'balance' in h or h == 'bal':
+                        guesses['balance'] = headers[i]
                 
                 # If we found debit/credit, we probably don't have a single amount column
                 if guesses['debit'] and guesses['credit']:
@@ -495,12 +1194,13 @@ class ImporterApp:
         """
         Parses a CSV file based on the user's column mapping.
         """
+        import csv
+        from decimal import Decimal
         transactions = []
         try:
-            with open(file_path, 'r', encoding='utf-8-sig') as f:
-                dialect = csv.Sniffer().sniff(f.read(1024))
-                f.seek(0)
-                reader = csv.DictReader(f, dialect=dialect)
+            with StatementReader(file_path) as f:
+                dialect = csv.Sniffer().sniff(f.sample())
+                reader = csv.DictReader(f.text_lines(), dialect=dialect)
                 
                 for row in reader:
                     current = {}
@@ -537,11 +1237,23 @@ class ImporterApp:
                             
                         # Amount is credit (inflow) minus debit (outflow)
                         current['amount'] = credit - debit
+                        current['debit'] = debit # Kept for the sign-convention checks
+                        current['credit'] = credit
                     
                     else:
                         # No amount found
                         current['amount'] = Decimal(0)
 
+                    # Running balance (optional), with the file row for reporting
+                    current['row'] = reader.line_num
+                    current['offset'] = f.offset
+                    if mapping.get('balance'):
+                        bal_str = (row.get(mapping['balance']) or '').replace(',', '').replace('$', '').strip()
+                        try:
+                            current['balance'] = Decimal(bal_str) if bal_str else None
+                        except Exception:
+                            current['balance'] = None
+
                     if current.get('date') and 'amount' in current:
                         transactions.append(current)
                 
@@ -554,6 +1266,7 @@ class ImporterApp:
     # --- GUI Top-Level Methods ---
     def load_db(self):
         """Opens file dialog to select DB, creates a backup, and loads accounts."""
+        import shutil  # Added for database backup functionality
         path = filedialog.askopenfilename(
             title="Select Frappe Books Database",
             filetypes=[("Database files", "*.db"), ("All files", "*.*")]
@@ -581,6 +1294,7 @@ class ImporterApp:
         # --- End Backup ---
 
         self.db_path.set(path)
+        self.balance_cache.clear() # Cached balances belong to the previous database
         
         try:
             conn = self.connect_db(path)
@@ -609,30 +1323,23 @@ class ImporterApp:
                  return # Error already logged
 
             self.all_accounts = self.get_accounts(conn)
+            self.schema_catalog = self.get_schema_catalog(conn)
             conn.close()
             
             if not self.all_accounts:
                 self.log_error("No accounts found in database.")
                 return
 
-            # Update option menus
-            self.bank_menu['menu'].delete(0, 'end')
-            self.suspense_menu['menu'].delete(0, 'end')
+            # Index accounts for the pickers; dropdowns are filled on demand
+            self.account_set = set(self.all_accounts)
+            self.account_index = AccountIndex(self.all_accounts, self.account_types)
             
-            for acc in self.all_accounts:
-                self.bank_menu['menu'].add_command(label=acc, command=tk._setit(self.bank_account, acc))
-                self.suspense_menu['menu'].add_command(label=acc, command=tk._setit(self.suspense_account, acc))
-                
             self.bank_account.set(self.all_accounts[0]) # Set default
+            self.restore_bank_account()
             
-            # Set default suspense account
-            if "Suspense Clearing" in self.all_accounts:
-                self.suspense_account.set("Suspense Clearing")
-            elif "Suspense Account" in self.all_accounts:
-                self.suspense_account.set("Suspense Account")
-            else:
-                self.suspense_account.set(self.all_accounts[0])
+            self.suspense_account.set(self.default_suspense_account())
             
+            self.save_session()
             self.log_status("Database loaded. Ready to load statement.")
             self.check_ready_to_import()
             
@@ -643,11 +1350,13 @@ class ImporterApp:
         """Opens file dialog to select statement file."""
         path = filedialog.askopenfilename(
             title="Select Bank Statement File",
+            initialdir=self.settings.get('last_statement_dir') or None,
             filetypes=[
-                ("All statement files", "*.qif *.ofx *.csv"),
+                ("All statement files", "*.qif *.ofx *.csv *.xml *.camt"),
                 ("QIF files", "*.qif"),
                 ("OFX files", "*.ofx"),
                 ("CSV files", "*.csv"),
+                ("ISO 20022 camt files", "*.xml *.camt"),
                 ("All files", "*.*")
             ]
         )
@@ -656,6 +1365,9 @@ class ImporterApp:
             
         self.statement_path.set(path)
         file_ext = os.path.splitext(path)[1].lower()
+        self.restore_bank_account()
+        self.settings['last_statement_dir'] = os.path.dirname(path)
+        self.save_settings()
         
         # Hide CSV frame by default
         self.csv_frame.grid_forget()
@@ -667,11 +1379,16 @@ class ImporterApp:
             
             headers, guesses = self.guess_csv_headers(path)
             self.csv_headers = [""] + headers # Add blank option
+            
+            # Prefer the mapping last used for this source, if its columns are all still there
+            remembered = self.settings.get('csv_mappings', {}).get(self._statement_source_key(path))
+            if remembered and all(col in headers for col in remembered.values() if col):
+                guesses = {**guesses, **remembered}
             self.csv_guesses = guesses
             
             # Update all CSV option menus
-            option_keys = ["Date", "Description", "Amount (Single)", "Debit (Two-Col)", "Credit (Two-Col)"]
-            guess_keys = ['date', 'desc', 'amt', 'debit', 'credit']
+            option_keys = ["Date", "Description", "Amount (Single)", "Debit (Two-Col)", "Credit (Two-Col)", "Balance (Running)"]
+            guess_keys = ['date', 'desc', 'amt', 'debit', 'credit', 'balance']
             
             for i, key in enumerate(option_keys):
                 menu = self.csv_option_menus[key]['menu']
@@ -700,14 +1417,713 @@ class ImporterApp:
             
         self.check_ready_to_import()
 
+    def default_suspense_account(self):
+        """Prefers the importer's "Suspense Clearing", then Frappe's "Suspense Account"."""
+        for name in ("Suspense Clearing", "Suspense Account"):
+            if name in self.account_set:
+                return name
+        return self.all_accounts[0]
+
+    def restore_bank_account(self):
+        """Selects the bank account last used for this statement's source, if known."""
+        path = self.statement_path.get()
+        if not path:
+            return
+        remembered = self.settings.get('last_bank_accounts', {}).get(self._statement_source_key(path))
+        if remembered in self.account_set:
+            self.bank_account.set(remembered)
+
     def check_ready_to_import(self):
         """Enables import button if all fields are set."""
-        if self.db_path.get() and self.statement_path.get() and self.bank_account.get() and self.suspense_account.get():
+        if (self.db_path.get() and self.statement_path.get()
+                and self.bank_account.get() in self.account_set
+                and self.suspense_account.get() in self.account_set):
             self.import_button.config(state='normal')
             self.log_status("Ready to import.")
         else:
             self.import_button.config(state='disabled')
 
+    def resolve_category_account(self, category):
+        """
+        Maps a QIF category ('Cat:Sub') to an existing account name. Transfers
+        ('[Other Account]') return None so they go to Suspense like an 'L' transfer:
+        the other account's own register posts the mirror entry.
+        """
+        if not category:
+            return None
+        category = category.strip()
+        if category.startswith('['):
+            return None
+        if category in self.account_set:
+            return category
+        sub_category = category.split(':')[-1].strip()
+        if sub_category in self.account_set:
+            return sub_category
+        return None
+
+    def resolve_bank_account(self, tx, bank_acc):
+        """A multi-account statement names the account each transaction belongs to; use it if it exists."""
+        source = tx.get('source_account')
+        if source in self.account_set:
+            return source
+        return bank_acc
+
+    def build_voucher_legs(self, tx, bank_acc, suspense_acc):
+        """
+        Builds the (account, debit, credit, remark) legs of one voucher.
+        amount > 0 is a Deposit (Inflow) -> Debit Bank, Credit the other side(s)
+        amount < 0 is a Withdrawal (Outflow) -> Credit Bank, Debit the other side(s)
+        QIF splits become one leg each. The rest goes to the transaction's own category
+        account (QIF 'L'), resolved like a split's, and otherwise to Suspense.
+        """
+        from decimal import Decimal
+        zero = Decimal('0')
+        tx_desc = tx.get('description', '')[:280] # Truncate description if too long
+        tx_amt = tx['amount'].quantize(Decimal('0.01'))
+        if tx_amt == 0:
+            return []
+        
+        bank_acc = self.resolve_bank_account(tx, bank_acc)
+        
+        legs = [(bank_acc, tx_amt, zero, tx_desc) if tx_amt > 0 else (bank_acc, zero, -tx_amt, tx_desc)]
+        
+        remainder = tx_amt
+        for split in tx.get('splits') or []:
+            split_amt = split['amount'].quantize(Decimal('0.01'))
+            if split_amt == 0:
+                continue
+            account = self.resolve_category_account(split.get('category')) or suspense_acc
+            remark = (split.get('memo') or tx_desc)[:280]
+            legs.append((account, zero, split_amt, remark) if split_amt > 0 else (account, -split_amt, zero, remark))
+            remainder -= split_amt
+        
+        if remainder != 0:
+            # A split transaction's 'L' only labels the splits; its remainder is unallocated
+            other_acc = suspense_acc if tx.get('splits') else (self.resolve_category_account(tx.get('category')) or suspense_acc)
+            legs.append((other_acc, zero, remainder, tx_desc) if remainder > 0 else (other_acc, -remainder, zero, tx_desc))
+        
+        return legs
+
+    # --- Duplicate Detection ---
+    def find_imported_refs(self, conn, transactions, bank_acc):
+        """
+        Returns the indices of transactions whose bank reference (camt AcctSvcrRef)
+        is already in the ledger for the same bank account, e.g. from yesterday's
+        overlapping statement file. One query per account over the statement's dates.
+        """
+        ledger_columns = self.schema_catalog.get(self.ledger_table_name, [])
+        if 'bankReference' not in ledger_columns:
+            return set()
+        
+        by_account = {} # account -> {ref: [transaction indices]}
+        for i, tx in enumerate(transactions):
+            if tx.get('ref') and tx.get('date'):
+                account = self.resolve_bank_account(tx, bank_acc)
+                by_account.setdefault(account, {}).setdefault(tx['ref'], []).append(i)
+        
+        duplicates = set()
+        cursor = conn.cursor()
+        for account, refs in by_account.items():
+            dates = [transactions[i]['date'] for indices in refs.values() for i in indices]
+            cursor.execute(f"SELECT DISTINCT bankReference FROM {self.ledger_table_name} "
+                           f"WHERE account = ? AND date >= ? AND date <= ? AND bankReference IS NOT NULL",
+                           (account, min(dates).strftime("%Y-%m-%d"), max(dates).strftime("%Y-%m-%d")))
+            for (ref,) in cursor.fetchall():
+                duplicates.update(refs.get(ref, ()))
+        return duplicates
+
+    # --- Transfer Matching ---
+    def match_transfers(self, transactions, bank_acc, window_days):
+        """
+        Pairs inflows with outflows of the same amount on a *different* bank account
+        within `window_days`. Outflows are hash-indexed by amount, each bucket sorted
+        by date, so every inflow only looks at its own date window.
+        Returns a list of (inflow_index, outflow_index) pairs.
+        """
+        from decimal import Decimal
+        accounts = [self.resolve_bank_account(tx, bank_acc) for tx in transactions]
+        
+        outflows = {} # amount -> sorted [(date ordinal, index)]
+        for i, tx in enumerate(transactions):
+            if tx.get('date') and tx['amount'] < 0:
+                outflows.setdefault(-tx['amount'].quantize(Decimal('0.01')), []).append((tx['date'].toordinal(), i))
+        for bucket in outflows.values():
+            bucket.sort()
+        
+        used = set()
+        pairs = []
+        for i, tx in enumerate(transactions):
+            if not tx.get('date') or tx['amount'] <= 0:
+                continue
+            bucket = outflows.get(tx['amount'].quantize(Decimal('0.01')))
+            if not bucket:
+                continue
+            day = tx['date'].toordinal()
+            best = None
+            pos = bisect.bisect_left(bucket, (day - window_days, -1))
+            while pos < len(bucket) and bucket[pos][0] <= day + window_days:
+                out_day, j = bucket[pos]
+                if j not in used and accounts[j] != accounts[i]:
+                    if best is None or abs(out_day - day) < abs(bucket[best][0] - day):
+                        best = pos
+                pos += 1
+            if best is not None:
+                j = bucket[best][1]
+                used.add(j)
+                pairs.append((i, j))
+        return pairs
+
+    def build_transfer_legs(self, tx_in, tx_out, bank_acc):
+        """One bank-to-bank voucher: Debit the receiving account, Credit the paying one."""
+        from decimal import Decimal
+        zero = Decimal('0')
+        amt = tx_in['amount'].quantize(Decimal('0.01'))
+        return [
+            (self.resolve_bank_account(tx_in, bank_acc), amt, zero, tx_in.get('description', '')[:280]),
+            (self.resolve_bank_account(tx_out, bank_acc), zero, amt, tx_out.get('description', '')[:280]),
+        ]
+
+    def match_existing_transfers(self, conn, transactions, candidates, bank_acc, suspense_acc, window_days):
+        """
+        Matches transactions against earlier imports from other bank accounts that
+        are still sitting in Suspense (two-leg vouchers only). Returns
+        {transaction index: match}; apply_existing_transfer() then re-points that
+        voucher's Suspense leg to the transaction's bank account.
+        """
+        from decimal import Decimal
+        dated = [i for i in candidates if transactions[i].get('date')]
+        if not dated:
+            return {}
+        first = min(transactions[i]['date'] for i in dated).toordinal() - window_days
+        last = max(transactions[i]['date'] for i in dated).toordinal() + window_days
+        
+        cursor = conn.cursor()
+        table = self.ledger_table_name
+        cursor.execute(f"""
+            SELECT s.rowid, s.voucherType, s.voucherNo, s.date, s.debit, s.credit, b.account
+            FROM {table} s
+            JOIN {table} b ON b.voucherType = s.voucherType AND b.voucherNo = s.voucherNo AND b.rowid != s.rowid
+            WHERE s.account = ? AND s.date BETWEEN ? AND ?
+              AND (SELECT COUNT(*) FROM {table} c WHERE c.voucherType = s.voucherType AND c.voucherNo = s.voucherNo) = 2
+        """, (suspense_acc, datetime.fromordinal(first).strftime("%Y-%m-%d"), datetime.fromordinal(last).strftime("%Y-%m-%d")))
+        
+        # Index by the other bank's signed amount: a Suspense debit was an outflow there
+        index = {}
+        for rowid, voucher_type, voucher_no, date_str, debit, credit, other_acc in cursor.fetchall():
+            try:
+                other_amt = (Decimal(credit or 0) - Decimal(debit or 0)).quantize(Decimal('0.01'))
+                day = datetime.strptime(date_str[:10], "%Y-%m-%d").toordinal()
+            except (ArithmeticError, ValueError, TypeError):
+                continue
+            index.setdefault(other_amt, []).append((day, rowid, voucher_type, voucher_no, other_acc))
+        for bucket in index.values():
+            bucket.sort()
+        
+        used = set()
+        matched = {}
+        for i in dated:
+            tx = transactions[i]
+            tx_acc = self.resolve_bank_account(tx, bank_acc)
+            bucket = index.get(-tx['amount'].quantize(Decimal('0.01')))
+            if not bucket:
+                continue
+            day = tx['date'].toordinal()
+            best = None
+            pos = bisect.bisect_left(bucket, (day - window_days,))
+            while pos < len(bucket) and bucket[pos][0] <= day + window_days:
+                if bucket[pos][1] not in used and bucket[pos][4] != tx_acc:
+                    if best is None or abs(bucket[pos][0] - day) < abs(bucket[best][0] - day):
+                        best = pos
+                pos += 1
+            if best is None:
+                continue
+            
+            _, rowid, voucher_type, voucher_no, _ = bucket[best]
+            used.add(rowid)
+            matched[i] = (rowid, voucher_type, voucher_no, tx_acc)
+        return matched
+
+    def apply_existing_transfer(self, cursor, match, suspense_acc, now):
+        """Turns a matched Suspense voucher into a bank-to-bank one (caller commits)."""
+        rowid, voucher_type, voucher_no, tx_acc = match
+        cursor.execute(f"UPDATE {self.ledger_table_name} SET account = ?, modified = ? WHERE rowid = ?", (tx_acc, now, rowid))
+        child_table = self._catalog_table('JournalEntryAccount')
+        if voucher_type == "JournalEntry" and child_table:
+            cursor.execute(f"UPDATE {child_table} SET account = ?, modified = ? WHERE parent = ? AND account = ?",
+                           (tx_acc, now, voucher_no, suspense_acc))
+
+    # --- Validation ---
+    def _tx_label(self, tx):
+        """Short reference to a transaction for reports: the CSV row, or date/amount/description."""
+        if tx.get('row'):
+            return f"row {tx['row']}"
+        return f"{tx['date']:%Y-%m-%d} {tx['amount']} '{tx.get('description', '')[:30]}'"
+
+    def _report_rows(self, message, transactions, indices):
+        examples = ", ".join(self._tx_label(transactions[i]) for i in indices[:3])
+        more = f" and {len(indices) - 3} more" if len(indices) > 3 else ""
+        return f"{len(indices)} {message}: {examples}{more}."
+
+    def _kth_smallest(self, values, k):
+        """
+        Returns the k-th smallest (0-based) of `values` in expected linear time: two
+        pivots from a sorted random sample around position k narrow the list to the
+        values between them, and only that small slice is sorted.
+        """
+        import random
+        while len(values) > 1000:
+            sample = sorted(random.sample(values, 500))
+            pos = k * len(sample) // len(values)
+            low, high = sample[max(0, pos - 40)], sample[min(len(sample) - 1, pos + 40)]
+            below = len([1 for v in values if v < low])
+            middle = [v for v in values if low <= v <= high]
+            if not below <= k < below + len(middle):
+                break # The sample missed k (rare); fall back to sorting what's left
+            values, k = middle, k - below
+        return sorted(values)[k]
+
+    def validate_transactions(self, transactions):
+        """
+        Screens the whole parsed batch before anything is written: dates outside the
+        statement period (or far from the bulk of the statement, e.g. a '%y' year
+        read as year 25), future dates, amount outliers, and sign-convention
+        problems. The per-row checks share a single pass over the batch.
+        Returns a list of findings; empty if nothing looks wrong.
+        """
+        import re
+        from collections import Counter
+        
+        n = len(transactions)
+        if not n:
+            return []
+        findings = []
+        info = self.statement_info
+        
+        # --- One pass over the batch for the per-row checks ---
+        today = datetime.now().replace(hour=23, minute=59, second=59)
+        has_period = bool(info.get('start_date') and info.get('end_date'))
+        if has_period:
+            low = info['start_date'].toordinal() - VALIDATION_DATE_GRACE_DAYS
+            high = info['end_date'].toordinal() + VALIDATION_DATE_GRACE_DAYS
+        split_columns = 'debit' in transactions[0] # Separate Debit/Credit CSV columns
+        future, outside, both, negative = [], [], [], []
+        months, magnitudes = [], []
+        add_month, add_magnitude = months.append, magnitudes.append # Bound once for the hot loop
+        for i, tx in enumerate(transactions):
+            d = tx['date']
+            if d > today:
+                future.append(i)
+            if has_period:
+                if not low <= d.toordinal() <= high:
+                    outside.append(i)
+            else:
+                add_month(d.year * 12 + d.month)
+            amount = tx['amount']
+            add_magnitude(amount.adjusted() if amount else None)
+            if split_columns and (tx['debit'] or tx['credit']):
+                debit, credit = tx['debit'], tx['credit']
+                if debit and credit:
+                    both.append(i)
+                if debit < 0 or credit < 0:
+                    negative.append(i)
+        
+        # --- Dates: future, and outside the statement period ---
+        if future:
+            findings.append(self._report_rows("transaction(s) dated in the future", transactions, future))
+        
+        if has_period:
+            what = (f"transaction(s) outside the statement period "
+                    f"{info['start_date']:%Y-%m-%d} to {info['end_date']:%Y-%m-%d}")
+        else:
+            # No period given: compare with the median month, found from a month histogram
+            counts = Counter(months)
+            seen = 0
+            for median_month in sorted(counts):
+                seen += counts[median_month]
+                if seen * 2 >= n:
+                    break
+            far = {month for month in counts if abs(month - median_month) > VALIDATION_MAX_MONTHS_FROM_MEDIAN}
+            if far:
+                outside = [i for i, month in enumerate(months) if month in far]
+            what = "transaction(s) dated far from the rest of the statement (check the year)"
+        if outside:
+            findings.append(self._report_rows(what, transactions, outside))
+        
+        # --- Amounts: far above the 90th percentile ---
+        # The percentile's order of magnitude comes from a histogram. Its exact value is
+        # only worked out when an amount sits right at the limit and needs it.
+        mag_counts = Counter(magnitudes)
+        mag_counts.pop(None, None)
+        nonzero = sum(mag_counts.values())
+        if nonzero >= 10:
+            seen = 0
+            for p90_magnitude in sorted(mag_counts):
+                seen += mag_counts[p90_magnitude]
+                if seen >= nonzero * 0.9:
+                    break
+            factor = 10 ** VALIDATION_OUTLIER_MAGNITUDES
+            limit = p90_magnitude + VALIDATION_OUTLIER_MAGNITUDES
+            if max(mag_counts) >= limit:
+                candidates = [i for i, m in enumerate(magnitudes) if m is not None and m >= limit]
+                # The percentile is below 10 ** (p90_magnitude + 1), so anything a further
+                # order of magnitude up is an outlier whatever its exact value
+                outliers = [i for i in candidates if magnitudes[i] > limit]
+                if len(outliers) < len(candidates):
+                    below = seen - mag_counts[p90_magnitude] # Amounts in lower magnitudes
+                    bucket = [abs(tx['amount']) for tx, m in zip(transactions, magnitudes) if m == p90_magnitude]
+                    p90 = self._kth_smallest(bucket, max(0, -(-nonzero * 9 // 10) - 1 - below))
+                    outliers = [i for i in candidates
+                                if magnitudes[i] > limit or abs(transactions[i]['amount']) >= p90 * factor]
+                if outliers:
+                    findings.append(self._report_rows(
+                        f"amount(s) at least {factor}x the 90th-percentile amount", transactions, outliers))
+        
+        # --- Sign conventions ---
+        if both:
+            findings.append(self._report_rows("row(s) with both a Debit and a Credit value", transactions, both))
+        if negative:
+            findings.append(self._report_rows(
+                "row(s) with negative Debit/Credit values (columns may already be signed)", transactions, negative))
+        
+        # Descriptions that clearly say "money in" or "money out" should mostly agree with the sign
+        inflow = re.compile(VALIDATION_INFLOW_WORDS, re.IGNORECASE)
+        outflow = re.compile(VALIDATION_OUTFLOW_WORDS, re.IGNORECASE)
+        step = max(1, n // VALIDATION_SIGN_SAMPLE)
+        agree = disagree = 0
+        for tx in transactions[::step]:
+            desc = tx.get('description') or ''
+            is_in, is_out = bool(inflow.search(desc)), bool(outflow.search(desc))
+            if is_in == is_out or not tx['amount']:
+                continue # No keyword, or both
+            if is_in == (tx['amount'] > 0):
+                agree += 1
+            else:
+                disagree += 1
+        if disagree >= 5 and disagree > 2 * agree:
+            findings.append(f"Amount signs look reversed: {disagree} of {agree + disagree} sampled deposits/withdrawals "
+                            f"have the opposite sign to their description (are the Debit/Credit columns swapped?).")
+        
+        return findings
+
+    # --- Reconciliation ---
+    def get_ledger_balance(self, conn, account, before_date):
+        """
+        Returns the account's ledger balance (debits - credits) before `before_date`
+        with one aggregated query. Results are cached per database and account together
+        with the ledger's highest rowid, so later calls only sum rows added since then.
+        Anything that moves existing rows between accounts must clear the cache.
+        """
+        from decimal import Decimal
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT MAX(rowid) FROM {self.ledger_table_name}")
+        high_water = cursor.fetchone()[0] or 0
+        
+        sum_sql = (f"SELECT TOTAL(CAST(debit AS REAL)) - TOTAL(CAST(credit AS REAL)) "
+                   f"FROM {self.ledger_table_name} WHERE account = ? AND date < ?")
+        
+        cache_key = (self.db_path.get(), account)
+        cached = self.balance_cache.get(cache_key)
+        if cached and cached[0] == before_date and cached[2] == high_water:
+            return cached[1]
+        if cached and cached[0] == before_date and cached[2] < high_water:
+            cursor.execute(sum_sql + " AND rowid > ?", (account, before_date, cached[2]))
+            balance = cached[1] + Decimal(str(round(cursor.fetchone()[0], 2)))
+        else:
+            cursor.execute(sum_sql, (account, before_date))
+            balance = Decimal(str(round(cursor.fetchone()[0], 2)))
+        
+        balance = balance.quantize(Decimal('0.01'))
+        self.balance_cache[cache_key] = (before_date, balance, high_water)
+        return balance
+
+    def check_running_balance(self, transactions):
+        """
+        Checks a running-balance column row by row, in whichever order the file is
+        in (oldest or newest first). Returns (opening_balance, [mismatch messages]).
+        """
+        rows = [tx for tx in transactions if tx.get('balance') is not None]
+        if len(rows) < 2:
+            if rows:
+                return rows[0]['balance'] - rows[0]['amount'], []
+            return None, []
+        
+        # Oldest first: previous balance + this amount == this balance
+        forward = [i for i in range(1, len(rows))
+                   if rows[i - 1]['balance'] + rows[i]['amount'] != rows[i]['balance']]
+        # Newest first: this balance + previous amount == previous balance
+        backward = [i for i in range(1, len(rows))
+                    if rows[i]['balance'] + rows[i - 1]['amount'] != rows[i - 1]['balance']]
+        
+        issues = []
+        if len(forward) <= len(backward):
+            opening = rows[0]['balance'] - rows[0]['amount']
+            for i in forward:
+                expected = rows[i - 1]['balance'] + rows[i]['amount']
+                issues.append(f"Row {rows[i].get('row')}: expected running balance {expected}, file shows {rows[i]['balance']}.")
+        else:
+            opening = rows[-1]['balance'] - rows[-1]['amount']
+            for i in backward:
+                expected = rows[i]['balance'] + rows[i - 1]['amount']
+                issues.append(f"Row {rows[i - 1].get('row')}: expected running balance {expected}, file shows {rows[i - 1]['balance']}.")
+        return opening, issues
+
+    def reconcile_statement(self, conn, transactions, bank_acc):
+        """
+        Compares the statement's opening balance (from its reported balances or a
+        running-balance column) with the bank account's ledger balance at the
+        statement's start date. Returns a list of issues; empty if it reconciles.
+        """
+        from decimal import Decimal
+        info = self.statement_info
+        own = [tx for tx in transactions if self.resolve_bank_account(tx, bank_acc) == bank_acc]
+        if not own:
+            return []
+        
+        issues = []
+        total = sum((tx['amount'] for tx in own), Decimal(0))
+        
+        opening, running_issues = self.check_running_balance(own)
+        issues.extend(running_issues[:10])
+        if len(running_issues) > 10:
+            issues.append(f"... and {len(running_issues) - 10} more running-balance mismatches.")
+        
+        if info.get('opening_balance') is not None:
+            opening = info['opening_balance']
+            if info.get('closing_balance') is not None and opening + total != info['closing_balance']:
+                issues.append(f"Statement does not add up: opening {opening} + transactions {total} "
+                              f"!= closing {info['closing_balance']}.")
+        elif opening is None and info.get('closing_balance') is not None:
+            opening = info['closing_balance'] - total
+        
+        if opening is None:
+            return issues # Nothing to reconcile against
+        
+        start_date = info.get('start_date') or min(tx['date'] for tx in own)
+        start_str = start_date.strftime("%Y-%m-%d")
+        ledger_balance = self.get_ledger_balance(conn, bank_acc, start_str)
+        
+        gap = ledger_balance - opening.quantize(Decimal('0.01'))
+        if gap != 0:
+            issues.insert(0, f"'{bank_acc}' has a ledger balance of {ledger_balance} before {start_str}, "
+                             f"but the statement opens at {opening} (difference {gap}).")
+        return issues
+
+    # --- Database Writers ---
+    def _insert_rows(self, cursor, table, rows):
+        """
+        Bulk-inserts dict rows into `table` in batched executemany() calls.
+        Keys the table doesn't have (per the schema catalog) are left out.
+        """
+        if not rows:
+            return
+        columns = [col for col in rows[0] if col in self.schema_catalog.get(table, rows[0])]
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+        for i in range(0, len(rows), IMPORT_BATCH_SIZE):
+            cursor.executemany(sql, [[row[col] for col in columns] for row in rows[i:i + IMPORT_BATCH_SIZE]])
+
+    def _next_ledger_name(self, cursor):
+        """Returns the next free numeric ledger entry name."""
+        start_name = 1
+        try:
+            # Try to get max numeric name
+            cursor.execute(f"SELECT MAX(CAST(name AS INTEGER)) FROM {self.ledger_table_name} WHERE name GLOB '[0-9]*'")
+            result = cursor.fetchone()
+            if result and result[0]:
+                start_name = int(result[0]) + 1
+        except Exception as e:
+            self.log_status(f"Could not find max ID, starting from 1. (Error: {e})")
+        return start_name
+
+    def _ledger_row(self, name, date, account, debit, credit, remark, voucher_type, voucher_no, now, document=None, ref=None):
+        """
+        One AccountingLedgerEntry row. `document` is a (schema name, name) pair for rows
+        posted by a Frappe document; it fills referenceType/referenceName, which is
+        how Frappe Books finds (and reverses) a document's ledger rows. `ref` is the
+        bank's reference for the statement entry, if it has one.
+        """
+        row = {
+            'name': str(name), 'date': date, 'party': None, 'account': account,
+            'debit': str(debit), 'credit': str(credit), 'remark': remark,
+            'voucherType': voucher_type, 'voucherNo': voucher_no, 'bankReference': ref, 'reverted': 0,
+            'createdBy': "system", 'modifiedBy': "system", 'created': now, 'modified': now,
+        }
+        if document:
+            row['referenceType'], row['referenceName'] = document
+        return row
+
+    def write_ledger_entries(self, conn, vouchers, now, start_name=None):
+        """
+        Writes vouchers as raw ledger rows (voucherType 'Bank Import'). Caller commits.
+        Returns the next free ledger name, so chunked writes needn't re-scan for it.
+        """
+        cursor = conn.cursor()
+        if start_name is None:
+            start_name = self._next_ledger_name(cursor)
+        
+        rows = []
+        for voucher in vouchers:
+            # Use a common voucher number for all entries
+            voucher_no = str(start_name)
+            for account, debit, credit, remark in voucher['legs']:
+                rows.append(self._ledger_row(start_name, voucher['date'], account, debit, credit, remark,
+                                             "Bank Import", voucher_no, now, ref=voucher.get('ref')))
+                start_name += 1
+        
+        self._insert_rows(cursor, self.ledger_table_name, rows)
+        return start_name
+
+    def _allocate_journal_names(self, cursor, count):
+        """
+        Reserves `count` Journal Entry names from the 'JV-' number series, never
+        reusing a name that already exists, and moves the series on.
+        """
+        je_table = self._catalog_table('JournalEntry')
+        series_table = self._catalog_table('NumberSeries')
+        prefix, pad_zeros, next_number = JOURNAL_ENTRY_SERIES, 4, 1
+        
+        series = None
+        if series_table:
+            try:
+                cursor.execute(f"SELECT start, padZeros, current FROM {series_table} WHERE name = ?", (prefix,))
+                series = cursor.fetchone()
+            except sqlite3.Error:
+                series = None
+        if series:
+            start, pad, current = series
+            pad_zeros = int(pad or pad_zeros)
+            next_number = int(current) + 1 if current and int(current) >= int(start or 1) else int(start or 1)
+        
+        # Skip past any names already taken (e.g. the series was edited)
+        cursor.execute(f"SELECT MAX(CAST(SUBSTR(name, ?) AS INTEGER)) FROM {je_table} WHERE name LIKE ?",
+                       (len(prefix) + 1, f"{prefix}%"))
+        taken = cursor.fetchone()[0]
+        if taken is not None:
+            next_number = max(next_number, int(taken) + 1)
+        
+        last_number = next_number + count - 1
+        if series:
+            cursor.execute(f"UPDATE {series_table} SET current = ? WHERE name = ?", (last_number, prefix))
+        return [f"{prefix}{str(n).zfill(pad_zeros)}" for n in range(next_number, last_number + 1)]
+
+    def write_journal_entries(self, conn, vouchers, now, start_name=None):
+        """
+        Writes vouchers as native JournalEntry documents: the parent, its
+        JournalEntryAccount children and the matching ledger rows, each table
+        bulk-inserted. Caller commits, so all three land in one transaction.
+        Returns the next free ledger name.
+        """
+        import secrets
+        je_table = self._catalog_table('JournalEntry')
+        child_table = self._catalog_table('JournalEntryAccount')
+        if not je_table or not child_table:
+            raise sqlite3.OperationalError("This database has no JournalEntry/JournalEntryAccount tables.")
+        
+        cursor = conn.cursor()
+        ledger_name = start_name if start_name is not None else self._next_ledger_name(cursor)
+        if not vouchers:
+            return ledger_name
+        
+        names = self._allocate_journal_names(cursor, len(vouchers))
+        
+        entries, children, ledger_rows = [], [], []
+        for je_name, voucher in zip(names, vouchers):
+            entries.append({
+                'name': je_name, 'entryType': "Bank Entry", 'date': voucher['date'],
+                'userRemark': voucher['description'], 'referenceNumber': voucher.get('ref'),
+                'referenceDate': voucher['date'] if voucher.get('ref') else None,
+                'numberSeries': JOURNAL_ENTRY_SERIES, 'submitted': 1, 'cancelled': 0,
+                'createdBy': "system", 'modifiedBy': "system", 'created': now, 'modified': now,
+            })
+            for idx, (account, debit, credit, remark) in enumerate(voucher['legs']):
+                children.append({
+                    'name': secrets.token_hex(5), 'parent': je_name, 'parentSchemaName': "JournalEntry",
+                    'parentFieldname': "accounts", 'idx': idx, 'account': account,
+                    'debit': str(debit), 'credit': str(credit),
+                    'createdBy': "system", 'modifiedBy': "system", 'created': now, 'modified': now,
+                })
+                ledger_rows.append(self._ledger_row(ledger_name, voucher['date'], account, debit, credit, remark,
+                                                    "JournalEntry", je_name, now, ("JournalEntry", je_name), voucher.get('ref')))
+                ledger_name += 1
+        
+        self._insert_rows(cursor, je_table, entries)
+        self._insert_rows(cursor, child_table, children)
+        self._insert_rows(cursor, self.ledger_table_name, ledger_rows)
+        return ledger_name
+
+    def write_vouchers(self, conn, vouchers, now, start_name=None):
+        """Writes vouchers in the selected import mode. Returns the next free ledger name."""
+        if self.create_journal_entries.get():
+            return self.write_journal_entries(conn, vouchers, now, start_name)
+        return self.write_ledger_entries(conn, vouchers, now, start_name)
+
+    # --- Checkpointed Imports ---
+    def file_hash(self, file_path):
+        """SHA-256 of the statement file, hashed straight from the memory map."""
+        import hashlib
+        with StatementReader(file_path) as reader:
+            return hashlib.sha256(reader.view).hexdigest()
+
+    def load_checkpoint(self, conn, file_hash):
+        """Returns the progress row (as a dict) recorded for this file, or None."""
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+                fileHash TEXT PRIMARY KEY, filePath TEXT, bankAccount TEXT,
+                vouchersDone INTEGER, byteOffset INTEGER, lastName TEXT,
+                completed INTEGER DEFAULT 0, modified TEXT)
+        """)
+        conn.commit()
+        cursor.execute(f"SELECT bankAccount, vouchersDone, byteOffset, lastName, completed, modified "
+                       f"FROM {PROGRESS_TABLE} WHERE fileHash = ?", (file_hash,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        keys = ('bankAccount', 'vouchersDone', 'byteOffset', 'lastName', 'completed', 'modified')
+        return dict(zip(keys, row))
+
+    def save_checkpoint(self, cursor, progress, now):
+        """Records progress in the caller's transaction, so it commits with the chunk it describes."""
+        cursor.execute(f"""
+            INSERT OR REPLACE INTO {PROGRESS_TABLE}
+            (fileHash, filePath, bankAccount, vouchersDone, byteOffset, lastName, completed, modified)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (progress['fileHash'], progress['filePath'], progress['bankAccount'], progress['vouchersDone'],
+              progress['byteOffset'], progress['lastName'], progress['completed'], now))
+
+    def write_in_checkpoints(self, conn, vouchers, relinks, suspense_acc, now, progress):
+        """
+        Writes vouchers in chunks of CHECKPOINT_CHUNK, each committed together with
+        its progress row, so the write lock is only held per chunk and an
+        interrupted import can resume after the last committed chunk.
+        `relinks` are (offset, match) pairs for transfers matched to existing entries.
+        """
+        cursor = conn.cursor()
+        relinks = sorted(relinks, key=lambda item: item[0])
+        next_name = None
+        r = 0
+        
+        for start in range(0, len(vouchers), CHECKPOINT_CHUNK):
+            chunk = vouchers[start:start + CHECKPOINT_CHUNK]
+            upto = chunk[-1]['offset']
+            while r < len(relinks) and relinks[r][0] <= upto:
+                self.apply_existing_transfer(cursor, relinks[r][1], suspense_acc, now)
+                r += 1
+            next_name = self.write_vouchers(conn, chunk, now, next_name)
+            
+            progress['vouchersDone'] += len(chunk)
+            progress['byteOffset'] = upto
+            progress['lastName'] = str(next_name - 1)
+            self.save_checkpoint(cursor, progress, now)
+            conn.commit()
+            self.log_status(f"Checkpoint: {progress['vouchersDone']} vouchers committed.")
+        
+        for offset, match in relinks[r:]:
+            self.apply_existing_transfer(cursor, match, suspense_acc, now)
+            progress['byteOffset'] = max(progress['byteOffset'] or 0, offset)
+        progress['completed'] = 1
+        self.save_checkpoint(cursor, progress, now)
+        conn.commit()
+
     def run_import(self):
         """Main function to parse the file and import to DB."""
 
@@ -743,9 +2159,14 @@ Do you understand the risks and wish to proceed with the import?"""
         if not all([db_path, file_path, bank_acc, suspense_acc]):
             self.log_error("Missing required fields.")
             return
+        for acc in (bank_acc, suspense_acc):
+            if acc not in self.account_set:
+                self.log_error(f"Unknown account: '{acc}'. Please pick an account from the list.")
+                return
 
         # --- 2. Parse the file ---
         transactions = []
+        self.statement_info = {}
         try:
             if file_ext == '.csv':
                 mapping = {
@@ -754,6 +2175,7 @@ Do you understand the risks and wish to proceed with the import?"""
                     'amt': self.csv_amt_var.get(),
                     'debit': self.csv_debit_var.get(),
                     'credit': self.csv_credit_var.get(),
+                    'balance': self.csv_balance_var.get(),
                 }
                 # Validation for CSV mapping
                 if not mapping['date'] or not mapping['desc']:
@@ -769,6 +2191,8 @@ Do you understand the risks and wish to proceed with the import?"""
                 transactions = self.parse_qif(file_path)
             elif file_ext == '.ofx':
                 transactions = self.parse_ofx(file_path)
+            elif file_ext in ('.xml', '.camt'):
+                transactions = self.parse_camt(file_path)
             else:
                 self.log_error(f"Unsupported file type: {file_ext}")
                 return
@@ -783,6 +2207,13 @@ Do you understand the risks and wish to proceed with the import?"""
             
         self.log_status(f"Parsed {len(transactions)} transactions. Importing to database...")
         
+        # --- Screen the whole batch before touching the database ---
+        try:
+            findings = self.validate_transactions(transactions)
+        except (ArithmeticError, TypeError, ValueError) as e:
+            findings = []
+            self.log_status(f"Could not validate transactions. (Error: {e})")
+        
         # --- 3. Import to Database ---
         conn = self.connect_db(db_path)
         if not conn:
@@ -795,84 +2226,175 @@ Do you understand the risks and wish to proceed with the import?"""
              conn.close()
              return
 
-        cursor = conn.cursor()
+        # --- Reconcile against the ledger before writing anything ---
+        try:
+            issues = self.reconcile_statement(conn, transactions, bank_acc)
+        except (sqlite3.Error, ArithmeticError) as e:
+            issues = []
+            self.log_status(f"Could not reconcile statement balances. (Error: {e})")
+        if not issues and (self.statement_info or any(tx.get('balance') is not None for tx in transactions)):
+            self.log_status("Statement reconciles with the ledger balance.")
         
-        # Get next ID for 'name'
-        start_name = 1
+        # One report for everything found before commit
+        if findings or issues:
+            sections = []
+            if findings:
+                sections.append("Validation:\n" + "\n".join(f"- {line}" for line in findings))
+            if issues:
+                sections.append("The statement does not reconcile with the ledger:\n" + "\n".join(f"- {line}" for line in issues))
+            report = "\n\n".join(sections)
+            if not messagebox.askyesno("Pre-Import Checks", f"{report}\n\nImport anyway?"):
+                conn.close()
+                self.log_status("Import cancelled after pre-import checks.")
+                return
+
+        # --- Skip entries an earlier (overlapping) statement already imported ---
         try:
-            # Try to get max numeric name
-            cursor.execute(f"SELECT MAX(CAST(name AS INTEGER)) FROM {self.ledger_table_name} WHERE name GLOB '[0-9]*'")
-            result = cursor.fetchone()
-            if result and result[0]:
-                start_name = int(result[0]) + 1
-        except Exception as e:
-            self.log_status(f"Could not find max ID, starting from 1. (Error: {e})")
+            duplicates = self.find_imported_refs(conn, transactions, bank_acc)
+        except sqlite3.Error as e:
+            duplicates = set()
+            self.log_status(f"Could not check for already-imported entries. (Error: {e})")
+        if duplicates:
+            transactions = [tx for i, tx in enumerate(transactions) if i not in duplicates]
+            self.log_status(f"Skipping {len(duplicates)} entries already imported (same bank reference).")
+            if not transactions:
+                conn.close()
+                self.log_status("Nothing to import: every entry is already in the ledger.")
+                messagebox.showinfo("Already Imported", "Every entry in this statement is already in the ledger.")
+                return
 
-        # Prepare INSERT statement
-        sql = f"""
-            INSERT INTO {self.ledger_table_name}
-            (name, date, party, account, debit, credit, remark, voucherType, voucherNo, createdBy, modifiedBy, created, modified)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
-        
+        cursor = conn.cursor()
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         import_count = 0
         
+        # Position of each transaction in the file, used to resume checkpointed imports
+        positions = [tx.get('offset', i) for i, tx in enumerate(transactions)]
+        
+        # --- Checkpoint mode: resume where an earlier run of this file stopped ---
+        progress = None
+        resume_offset = None
+        if self.checkpoint_import.get():
+            try:
+                file_hash = self.file_hash(file_path)
+                saved = self.load_checkpoint(conn, file_hash)
+            except (OSError, sqlite3.Error) as e:
+                conn.close()
+                self.log_error(f"Could not read import progress: {e}")
+                return
+            progress = {'fileHash': file_hash, 'filePath': file_path, 'bankAccount': bank_acc,
+                        'vouchersDone': 0, 'byteOffset': None, 'lastName': None, 'completed': 0}
+            if saved and saved['completed']:
+                if not messagebox.askyesno("Already Imported",
+                                           f"This file was already imported (finished {saved['modified']}).\n\nImport it again?"):
+                    conn.close()
+                    self.log_status("Import cancelled: file already imported.")
+                    return
+            elif saved:
+                if saved['bankAccount'] != bank_acc:
+                    conn.close()
+                    self.log_error(f"This file's import was started into '{saved['bankAccount']}'. Select that account to resume it.")
+                    return
+                resume_offset = saved['byteOffset']
+                progress['vouchersDone'] = saved['vouchersDone']
+                self.log_status(f"Resuming import: {saved['vouchersDone']} vouchers were already committed.")
+        
         try:
-            for tx in transactions:
+            # --- Match internal transfers between our own bank accounts ---
+            transfers = {} # index of the later transaction of a pair -> index of the earlier one
+            consumed = set()
+            existing = {}
+            if self.detect_transfers.get():
+                window = max(0, int(self.transfer_window_days.get()))
+                for i, j in self.match_transfers(transactions, bank_acc, window):
+                    transfers[max(i, j)] = min(i, j)
+                    consumed.update((i, j))
+                remaining = [i for i in range(len(transactions))
+                             if i not in consumed and transactions[i]['amount'] != 0
+                             and (resume_offset is None or positions[i] > resume_offset)]
+                if remaining: # Nothing left when every transaction was paired within the file
+                    existing = self.match_existing_transfers(conn, transactions, remaining, bank_acc, suspense_acc, window)
+                    consumed |= set(existing)
+                if transfers or existing:
+                    self.log_status(f"Matched {len(transfers) + len(existing)} internal transfer(s), "
+                                    f"{len(existing)} against existing entries.")
+
+            # --- Build one voucher (a set of balanced legs) per transaction ---
+            vouchers = []
+            for i, tx in enumerate(transactions):
                 if not tx.get('date'):
                     self.log_status(f"Skipping transaction, invalid date: {tx.get('description')}")
                     continue
+                if resume_offset is not None and positions[i] <= resume_offset:
+                    continue # Committed by an earlier run
 
-                # Get data
-                tx_date = tx['date'].strftime("%Y-%m-%d") # Format as YYYY-MM-DD
-                tx_desc = tx.get('description', '')[:280] # Truncate description if too long
-                tx_amt = tx['amount'].quantize(Decimal('0.01'))
-                
-                # --- Double-Entry Logic ---
-                # amount > 0 is a Deposit (Inflow) -> Debit Bank, Credit Suspense
-                # amount < 0 is a Withdrawal (Outflow) -> Credit Bank, Debit Suspense
-                
-                if tx_amt > 0:
-                    # Deposit
-                    debit_acc = bank_acc
-                    credit_acc = suspense_acc
-                    amt = tx_amt
-                elif tx_amt < 0:
-                    # Withdrawal
-                    debit_acc = suspense_acc
-                    credit_acc = bank_acc
-                    amt = -tx_amt # Amount is positive
+                if i in transfers:
+                    partner = transactions[transfers[i]]
+                    tx_in, tx_out = (tx, partner) if tx['amount'] > 0 else (partner, tx)
+                    legs = self.build_transfer_legs(tx_in, tx_out, bank_acc)
+                    date = min(tx['date'], partner['date'])
+                    description = f"Transfer: {tx_out.get('description', '')} / {tx_in.get('description', '')}"
+                elif i in consumed:
+                    continue # Other half of a transfer, or matched to an existing entry
                 else:
+                    legs = self.build_voucher_legs(tx, bank_acc, suspense_acc)
+                    date = tx['date']
+                    description = tx.get('description', '')
+                if not legs:
                     continue # Skip zero-amount transactions
 
-                # Use a common voucher number for both entries
-                voucher_no = str(start_name)
-
-                # Entry 1: Debit Side
-                name1 = str(start_name)
-                data1 = (name1, tx_date, None, debit_acc, str(amt), "0", tx_desc, "Bank Import", voucher_no, "system", "system", now, now)
-                cursor.execute(sql, data1)
+                vouchers.append({
+                    'date': date.strftime("%Y-%m-%d"), # Format as YYYY-MM-DD
+                    'description': description[:280],
+                    'legs': legs,
+                    'offset': positions[i],
+                    'ref': tx.get('ref'),
+                    'tx_count': 2 if i in transfers else 1,
+                })
+            
+            relinks = [(positions[i], match) for i, match in existing.items()]
+            import_count = sum(v['tx_count'] for v in vouchers) + len(relinks)
+            
+            if relinks:
+                self.balance_cache.clear() # Relinks move existing rows between accounts
+            if progress is not None:
+                self.write_in_checkpoints(conn, vouchers, relinks, suspense_acc, now, progress)
+            else:
+                for _, match in relinks:
+                    self.apply_existing_transfer(cursor, match, suspense_acc, now)
+                self.write_vouchers(conn, vouchers, now)
                 
-                # Entry 2: Credit Side
-                name2 = str(start_name + 1)
-                data2 = (name2, tx_date, None, credit_acc, "0", str(amt), tx_desc, "Bank Import", voucher_no, "system", "system", now, now)
-                cursor.execute(sql, data2)
-
-                start_name += 2
-                import_count += 1
+                # Commit all transactions at once
+                conn.commit()
+            
+            # Refresh planner statistics so the new indexes keep being used
+            if import_count >= ANALYZE_THRESHOLD:
+                try:
+                    cursor.execute(f"ANALYZE {self.ledger_table_name}")
+                    conn.commit()
+                except sqlite3.Error as e:
+                    self.log_status(f"Could not update statistics (Error: {e})")
             
-            # Commit all transactions at once
-            conn.commit()
             conn.close()
             
+            # Remember the bank account (and CSV mapping) for the next statement from this source
+            source_key = self._statement_source_key(file_path)
+            self.settings.setdefault('last_bank_accounts', {})[source_key] = bank_acc
+            if file_ext == '.csv':
+                self.settings.setdefault('csv_mappings', {})[source_key] = mapping
+            self.save_settings()
+            self.remember_session_accounts()
+            
             self.log_status(f"Successfully imported {import_count} transactions.")
             messagebox.showinfo("Success", f"Successfully imported {import_count} transactions.")
 
         except Exception as e:
             conn.rollback() # Roll back any changes if an error occurs
             conn.close()
-            self.log_error(f"Error during import: {e}")
+            if progress is not None and progress['vouchersDone']:
+                self.log_error(f"Error during import: {e}\n\n{progress['vouchersDone']} vouchers were committed. "
+                               "Import the same file again to resume.")
+            else:
+                self.log_error(f"Error during import: {e}")
 
 
 # --- Main execution ---